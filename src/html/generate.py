@@ -1,21 +1,37 @@
 # pyright: basic
 from dataclasses import dataclass, field
 from pathlib import Path
-import json
+import os
+import struct
 import sys
 from typing import Any
 
+try:
+    import orjson as json
+except ImportError:
+    import json
 
-@dataclass
+
+@dataclass(slots=True)
 class Node:
-    index: int = -1
-    terminal: str | None = None
-    cut: str = ""
+    index: int
+    terminal_bytes: bytes | None = None
     children: dict[str, "Node"] = field(default_factory=dict)
 
 
+def write_file(path: str, data: bytes | bytearray):
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(path, flags, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
 try:
-    entities: dict[str, Any] = json.loads(Path("./entities.json").read_text())
+    entities: dict[str, Any] = json.loads(Path("./entities.json").read_bytes())
 except FileNotFoundError:
     print("entities.json not found", file=sys.stderr)
     print(
@@ -23,72 +39,103 @@ except FileNotFoundError:
     )
     exit(1)
 
-trie = Node(0)
-
-for entity, value in entities.items():
-    characters: str = value["characters"]
-    current = trie
-    for chr in entity[1:]:
-        if chr in current.children:
-            next_node = current.children[chr]
-        else:
-            next_node = current.children[chr] = Node()
-        current = next_node
-    assert current.terminal is None
-    current.terminal = characters
-
-
-def cut_tree(node: Node):
-    if len(node.children) == 1:
-        while True:
-            key, value = next(iter(node.children.items()))
-            if len(value.children) == 1 and value.terminal is None:
-                next_key, next_value = next(iter(value.children.items()))
-                del node.children[key]
-                node.children[key + next_key] = next_value
-            else:
-                break
-
-    for child in node.children.values():
-        cut_tree(child)
+# The trie is first built out of plain dictionaries keyed by characters, the
+# UTF-8 encoded terminal of a node (if any) is stored under the `None` key.
+TrieDict = dict[str | None, Any]
+
+trie: TrieDict = {}
+
+# Entities are inserted in sorted order, this way only the part of a name that
+# diverges from the previously inserted one has to be walked and all of its
+# nodes are guaranteed to be new.
+path = [trie]
+previous = ""
+for entity, value in sorted(entities.items()):
+    name = entity[1:]
+    common = 0
+    max_common = min(len(previous), len(name))
+    while common < max_common and previous[common] == name[common]:
+        common += 1
+
+    del path[common + 1 :]
+    current = path[common]
+    for chr in name[common:]:
+        assert chr not in current
+        child: TrieDict = {}
+        current[chr] = child
+        path.append(child)
+        current = child
+    assert None not in current
+    current[None] = value["characters"].encode()
+    previous = name
+
+
+def cut_tree(root: TrieDict):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        keys = [key for key in node if key is not None]
+        if len(keys) == 1:
+            key = keys[0]
+            parts = [key]
+            value = node[key]
+            while len(value) == 1 and None not in value:
+                ((next_key, value),) = value.items()
+                parts.append(next_key)
+            if len(parts) > 1:
+                del node[key]
+                node["".join(parts)] = value
+
+        stack.extend(child for key, child in node.items() if key is not None)
 
 
 cut_tree(trie)
 
-preorder_nodes = [trie]
-next_index = 1
-
 
-def index_tree(node: Node):
-    global next_index
-    for child in node.children.values():
-        child.index = next_index
-        preorder_nodes.append(child)
-        next_index += 1
-        index_tree(child)
+def build_tree(root: TrieDict) -> list[Node]:
+    preorder_nodes: list[Node] = []
+    # Children are pushed in reverse so that they're popped in insertion order.
+    stack: list[tuple[Node | None, str, TrieDict]] = [(None, "", root)]
+    while stack:
+        parent, key, value = stack.pop()
+        node = Node(len(preorder_nodes), value.get(None))
+        preorder_nodes.append(node)
+        if parent is not None:
+            parent.children[key] = node
+        stack.extend(
+            (node, child_key, child)
+            for child_key, child in reversed(value.items())
+            if child_key is not None
+        )
+    return preorder_nodes
 
 
-index_tree(trie)
+preorder_nodes = build_tree(trie)
 
 
 @dataclass
-class Relocation:
-    index: int
+class Layout:
     address: int
+    # Everything up to `next_off`, this doesn't depend on any child addresses
+    # so it can be fully assembled while laying out the trie.
+    header: bytes
+    next_len: int
 
 
 DENSE_TABLE_RANGE = 74
 DENSE_TABLE_BASE = ord("1")
+DENSE_TABLE_STRUCT = struct.Struct(f"<{DENSE_TABLE_RANGE}H")
 
-memory = bytearray()
-relocations: list[Relocation] = []
-addresses: dict[int, int] = {}
+# Lay out all nodes before emitting anything so that child addresses are
+# already known when writing out a node's next-node lookup structure.
+layouts: list[Layout] = []
 
-ptr = 0
+address = 0
 for node in preorder_nodes:
-    addresses[node.index] = len(memory)
+    assert node.index == len(layouts)
 
-    terminal_len = len(node.terminal.encode()) if node.terminal is not None else 0
+    terminal = node.terminal_bytes or b""
+    terminal_len = len(terminal)
 
     next_len = len(node.children)
     if next_len >= 8:
@@ -98,65 +145,83 @@ for node in preorder_nodes:
         next_len = 0x80 | len(key)
 
     next_off = 3 + terminal_len
-    next_pad = (len(memory) + next_off) & 1
+    next_pad = (address + next_off) & 1
     next_off += next_pad
 
-    memory.append(terminal_len)
-    memory.append(next_len)
-    memory.append(next_off)
-    if node.terminal:
-        memory.extend(node.terminal.encode())
-
+    header = bytes((terminal_len, next_len, next_off)) + terminal
     if next_len > 0:
-        for _ in range(next_pad):
-            memory.append(0)
+        header += bytes(next_pad)
+
+    layouts.append(Layout(address, header, next_len))
+    address += len(header)
 
+    if next_len >= 0x80:
+        address += 2 + (next_len ^ 0x80)
+    elif next_len == DENSE_TABLE_RANGE:
+        address += DENSE_TABLE_STRUCT.size
+    else:
+        address += 4 * next_len
+
+# The total size is known after layout so everything can be written in place.
+memory = bytearray(address)
+
+pos = 0
+for node, layout in zip(preorder_nodes, layouts):
+    assert layout.address == pos
+    memory[pos : pos + len(layout.header)] = layout.header
+    pos += len(layout.header)
+
+    next_len = layout.next_len
     if next_len >= 0x80:
         assert next_len > 0x80
         key, target = next(iter(node.children.items()))
-        relocations.append(Relocation(target.index, len(memory)))
-        memory.extend([0, 0])
-        memory.extend(key.encode())
+        struct.pack_into("<H", memory, pos, layouts[target.index].address)
+        pos += 2
+        memory[pos : pos + len(key)] = key.encode()
+        pos += len(key)
     elif next_len == DENSE_TABLE_RANGE:
-        offset = len(memory)
-        memory.extend([0, 0] * DENSE_TABLE_RANGE)
+        table = [0] * DENSE_TABLE_RANGE
         for key, target in node.children.items():
             ascii_off = ord(key) - DENSE_TABLE_BASE
             assert ascii_off in range(0, DENSE_TABLE_RANGE)
-            ptr = offset + ascii_off * 2
-            relocations.append(Relocation(target.index, ptr))
+            table[ascii_off] = layouts[target.index].address
+        DENSE_TABLE_STRUCT.pack_into(memory, pos, *table)
+        pos += DENSE_TABLE_STRUCT.size
     else:
         for key, target in node.children.items():
-            memory.append(ord(key))
-            memory.append(0)
-            relocations.append(Relocation(target.index, len(memory)))
-            memory.extend([0, 0])
-
-for relocation in relocations:
-    ptr = relocation.address
-    target_addr = addresses[relocation.index]
-    target_addr_bytes = target_addr.to_bytes(2, "little")
-    memory[ptr + 0] = target_addr_bytes[0]
-    memory[ptr + 1] = target_addr_bytes[1]
-
-Path("./trie_little_endian.bin").write_bytes(memory)
-
-with Path("./all_entities_test.rs").open("w+") as f:
-    f.write("#[allow(clippy::invisible_characters)]\n")
-    f.write("\n")
-    f.write("#[test]\n")
-    f.write("fn all_entities() {\n")
-
-    for entity, value in entities.items():
-        entity = entity[1:]
-        characters = value["characters"]
-        esc = characters
-        if esc == '"':
-            esc = '\\"'
-        elif esc == "\\":
-            esc = "\\\\"
-        f.write(
-            f'\tassert_eq!(super::consume(b"{entity}"), Some(("{esc}", {len(entity)})));\n'
+            struct.pack_into(
+                "<BBH", memory, pos, ord(key), 0, layouts[target.index].address
+            )
+            pos += 4
+
+assert pos == len(memory)
+
+write_file("./trie_little_endian.bin", memory)
+
+RUST_STRING_ESCAPES = str.maketrans({'"': '\\"', "\\": "\\\\"})
+
+test_parts = [
+    "#[allow(clippy::invisible_characters)]\n",
+    "\n",
+    "#[test]\n",
+    "fn all_entities() {\n",
+]
+
+for entity, value in entities.items():
+    entity = entity[1:]
+    esc = value["characters"].translate(RUST_STRING_ESCAPES)
+    test_parts.extend(
+        (
+            '\tassert_eq!(super::consume(b"',
+            entity,
+            '"), Some(("',
+            esc,
+            '", ',
+            str(len(entity)),
+            ")));\n",
         )
+    )
+
+test_parts.append("}\n")
 
-    f.write("}\n")
+write_file("./all_entities_test.rs", "".join(test_parts).encode())
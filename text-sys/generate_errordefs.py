@@ -5,6 +5,7 @@
 #
 import subprocess as sp
 import re
+import sys
 from pathlib import Path
 
 include_dir = (
@@ -16,12 +17,14 @@ ft_errdef_h = f"{include_dir}/freetype/fterrdef.h"
 
 
 errdef_re = re.compile(
-    r'FT_ERRORDEF_\(\s*([A-Za-z_]+),\s*([0-9x]+),\s*"([^"]+)"', re.DOTALL
+    rb'FT_ERRORDEF_\(\s*([A-Za-z_]+),\s*([0-9x]+),\s*"([^"]+)"', re.DOTALL
 )
 
-print("pub const FREETYPE_ERRORS: &[(FT_Error, &str)] = &[")
+lines = ["pub const FREETYPE_ERRORS: &[(FT_Error, &str)] = &[\n"]
 
-for _ident, code, msg in errdef_re.findall(Path(ft_errdef_h).read_text()):
-    print(f'\t({code}, "{msg}"),')
+for _ident, code, msg in errdef_re.findall(Path(ft_errdef_h).read_bytes()):
+    lines.append(f'\t({code.decode()}, "{msg.decode()}"),\n')
 
-print("];")
+lines.append("];\n")
+
+sys.stdout.write("".join(lines))